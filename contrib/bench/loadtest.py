@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Load test for the git worker.
+
+Replays a mix of Merge and CherryPickMerge messages at a target rate
+through the real GitWorker.process against an in-process stand-in for
+the bus and local bare repos, then reports latency percentiles,
+throughput, queue backlog and resource usage.
+"""
+
+import json
+import logging
+import optparse
+import os
+import Queue
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import pika
+import pika.spec
+
+REPLY_QUEUE = 'loadtest.replies'
+
+#: Bus configuration handed to the worker. The stand-in ignores it.
+STANDIN_MQ_CONFIG = {
+    'server': '127.0.0.1',
+    'port': 5672,
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+
+class StandInChannel(object):
+    """
+    Stand-in for a pika channel which records what the worker publishes.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.connection = broker.connection
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+    def basic_consume(self, consumer_callback, queue='', **kwargs):
+        return 'ctag.%s' % queue
+
+    def basic_cancel(self, callback=None, consumer_tag='', **kwargs):
+        pass
+
+    def queue_declare(self, callback=None, queue='', **kwargs):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        if routing_key == REPLY_QUEUE:
+            self.broker.reply(properties.correlation_id, body)
+
+
+class StandInIOLoop(object):
+    """
+    Stand-in for the pika ioloop. The load test drives the worker itself.
+    """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class StandInConnection(object):
+    """
+    Stand-in for pika.SelectConnection.
+    """
+
+    broker = None
+
+    def __init__(self, *args, **kwargs):
+        self.ioloop = StandInIOLoop()
+
+    def channel(self, on_open_callback=None, channel_number=None):
+        channel = StandInChannel(self.broker)
+        if on_open_callback:
+            on_open_callback(channel)
+        return channel
+
+    def add_timeout(self, deadline, callback_method):
+        pass
+
+    def close(self, *args, **kwargs):
+        pass
+
+
+class StandInBroker(object):
+    """
+    In-process stand-in for the bus holding the worker queue and
+    collecting replies.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.connection = None
+        self.enqueued = {}
+        self.replies = {}
+        self.backlog = []
+        self._lock = threading.Lock()
+
+    def publish(self, corr_id, body):
+        """
+        Puts a message on the worker queue.
+        """
+        self.backlog.append(self.queue.qsize())
+        self.enqueued[corr_id] = time.time()
+        self.queue.put((corr_id, body))
+
+    def reply(self, corr_id, body):
+        """
+        Records the first reply for a correlation id.
+        """
+        with self._lock:
+            if corr_id not in self.replies:
+                self.replies[corr_id] = (time.time(), json.loads(body)
+                                         if isinstance(body, basestring)
+                                         else body)
+
+
+def _git(cwd, *args):
+    """
+    Runs a git command for fixture setup.
+    """
+    subprocess.check_call(
+        ['git'] + list(args), cwd=cwd,
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+
+def _commit_file(seed, name):
+    """
+    Commits a new file in the seed clone and returns the commit id.
+    """
+    with open(os.path.join(seed, name), 'w') as change:
+        change.write('%s\n' % name)
+    _git(seed, 'add', name)
+    _git(seed, 'commit', '-q', '-m', 'Add %s' % name)
+    return subprocess.Popen(
+        ['git', 'rev-parse', 'HEAD'], cwd=seed,
+        stdout=subprocess.PIPE).communicate()[0].strip()
+
+
+def create_fixtures(workdir, plan, picks):
+    """
+    Creates a bare origin repo with a branch per planned message and
+    returns the message bodies.
+    """
+    origin = os.path.join(workdir, 'origin.git')
+    seed = os.path.join(workdir, 'seed')
+    _git(workdir, 'init', '-q', '--bare', origin)
+    # Do not depend on init.defaultBranch; clones must check out master
+    _git(origin, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+    _git(workdir, 'clone', '-q', origin, seed)
+    _git(seed, 'checkout', '-q', '-b', 'master')
+    _commit_file(seed, 'README')
+    _git(seed, 'branch', 'release')
+
+    bodies = []
+    for number, subcommand in enumerate(plan):
+        branch = 'loadtest/%s-%s' % (subcommand.lower(), number)
+        _git(seed, 'checkout', '-q', '-b', branch, 'master')
+        if subcommand == 'Merge':
+            _commit_file(seed, 'merge-%s' % number)
+            parameters = {
+                'from_branch': branch,
+                'to_branch': 'master',
+            }
+        else:
+            commits = [
+                _commit_file(seed, 'pick-%s-%s' % (number, pick))
+                for pick in range(picks)]
+            parameters = {
+                'commits': commits,
+                'to_branch': 'release',
+            }
+        parameters.update({
+            'command': 'git',
+            'subcommand': subcommand,
+            'repo': origin,
+        })
+        bodies.append({'parameters': parameters})
+    _git(seed, 'push', '-q', 'origin', '--all')
+    return bodies
+
+
+def make_plan(mix, messages, seed):
+    """
+    Returns a list of subcommands following the weights in mix.
+    """
+    weights = []
+    for item in mix.split(','):
+        subcommand, _, weight = item.partition('=')
+        weights.append((subcommand.strip(), float(weight or 1)))
+    total = sum(weight for _, weight in weights)
+    rand = random.Random(seed)
+    plan = []
+    for _ in range(messages):
+        point = rand.uniform(0, total)
+        for subcommand, weight in weights:
+            point -= weight
+            if point <= 0:
+                break
+        plan.append(subcommand)
+    return plan
+
+
+def produce(broker, bodies, rate, arrival, seed):
+    """
+    Publishes bodies to the broker at rate messages per second.
+    """
+    rand = random.Random(seed)
+    due = time.time()
+    for number, body in enumerate(bodies):
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        broker.publish('loadtest-%s' % number, body)
+        if arrival == 'poisson':
+            due += rand.expovariate(rate)
+        else:
+            due += 1.0 / rate
+
+
+def consume(broker, worker, count, output):
+    """
+    Runs the worker's process loop until count messages were handled.
+    """
+    backlog = []
+    completed = {}
+    peak_git_rss = 0
+    for delivery_tag in range(1, count + 1):
+        corr_id, body = broker.queue.get()
+        backlog.append(broker.queue.qsize())
+        worker.process(
+            broker.channel,
+            pika.spec.Basic.Deliver(
+                delivery_tag=delivery_tag, routing_key=worker._queue),
+            pika.BasicProperties(
+                correlation_id=corr_id, reply_to=REPLY_QUEUE),
+            body,
+            output)
+        completed[corr_id] = time.time()
+        peak_git_rss = max(
+            peak_git_rss, worker._job_stats.get('git_peak_rss_kb', 0))
+    return completed, backlog, peak_git_rss
+
+
+def _percentile(values, pct):
+    """
+    Returns the pct percentile of values.
+    """
+    values = sorted(values)
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-m', '--mq-config',
+        help='bus configuration file to hand to the worker')
+    parser.add_option(
+        '-n', '--messages', type='int', default=50,
+        help='number of messages to replay')
+    parser.add_option(
+        '-r', '--rate', type='float', default=1.0,
+        help='target messages per second')
+    parser.add_option(
+        '--mix', default='Merge=1,CherryPickMerge=1',
+        help='weighted subcommand mix, e.g. Merge=3,CherryPickMerge=1')
+    parser.add_option(
+        '--arrival', choices=['uniform', 'poisson'], default='uniform',
+        help='message arrival pattern')
+    parser.add_option(
+        '--picks', type='int', default=2,
+        help='commits per CherryPickMerge')
+    parser.add_option(
+        '--cache', action='store_true',
+        help='enable the local repo cache')
+    parser.add_option(
+        '--seed', type='int', default=0, help='random seed')
+    parser.add_option(
+        '--keep', action='store_true', help='keep the work directory')
+    parser.add_option(
+        '--json', action='store_true', help='print the report as JSON')
+    options, args = parser.parse_args()
+
+    plan = make_plan(options.mix, options.messages, options.seed)
+    unknown = set(plan) - set(['Merge', 'CherryPickMerge'])
+    if unknown:
+        parser.error('unknown subcommands in mix: %s' % ', '.join(unknown))
+
+    for name, value in (('NAME', 'Load Test'), ('EMAIL', 'loadtest@localhost')):
+        os.environ.setdefault('GIT_AUTHOR_' + name, value)
+        os.environ.setdefault('GIT_COMMITTER_' + name, value)
+
+    workdir = tempfile.mkdtemp(prefix='re-worker-git-loadtest-')
+    try:
+        bodies = create_fixtures(workdir, plan, options.picks)
+
+        config = {'workspace_dir': os.path.join(workdir, 'workspaces')}
+        if options.cache:
+            config['cache_dir'] = os.path.join(workdir, 'cache')
+            os.makedirs(config['cache_dir'])
+        os.makedirs(config['workspace_dir'])
+        config_file = os.path.join(workdir, 'config.json')
+        json.dump(config, open(config_file, 'w'))
+
+        logging.basicConfig(level=logging.WARN)
+        broker = StandInBroker()
+        StandInConnection.broker = broker
+        broker.connection = StandInConnection()
+        pika.SelectConnection = StandInConnection
+
+        from replugin import gitworker
+        mq_config = STANDIN_MQ_CONFIG
+        if options.mq_config:
+            mq_config = json.load(open(options.mq_config))
+        worker = gitworker.GitWorker(
+            mq_config,
+            config_file=config_file,
+            logger=logging.getLogger('loadtest.worker'))
+        broker.channel = StandInChannel(broker)
+        worker._on_open(broker.connection)
+        worker._on_channel_open(broker.channel)
+
+        producer = threading.Thread(
+            target=produce,
+            args=(broker, bodies, options.rate, options.arrival,
+                  options.seed))
+        producer.daemon = True
+        self_before = resource.getrusage(resource.RUSAGE_SELF)
+        child_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        producer.start()
+        completed, backlog, peak_git_rss = consume(
+            broker, worker, len(bodies), logging.getLogger('loadtest.output'))
+        finished = time.time()
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        child_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir)
+
+    latencies = []
+    failed = 0
+    for corr_id, enqueued in broker.enqueued.items():
+        latencies.append(completed[corr_id] - enqueued)
+        _, reply = broker.replies.get(corr_id, (None, {}))
+        if reply.get('status') != 'completed':
+            failed += 1
+
+    elapsed = finished - start
+    report = {
+        'messages': len(bodies),
+        'mix': dict((name, plan.count(name)) for name in set(plan)),
+        'failed': failed,
+        'target_per_minute': options.rate * 60,
+        'throughput_per_minute': 60.0 * len(bodies) / elapsed,
+        'elapsed': elapsed,
+        'latency': {
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': max(latencies),
+        },
+        'backlog': {
+            'mean': float(sum(backlog)) / len(backlog),
+            'max': max(backlog),
+            'max_on_publish': max(broker.backlog),
+        },
+        'resources': {
+            'worker_cpu_user': self_after.ru_utime - self_before.ru_utime,
+            'worker_cpu_system': self_after.ru_stime - self_before.ru_stime,
+            'git_cpu_user': child_after.ru_utime - child_before.ru_utime,
+            'git_cpu_system': child_after.ru_stime - child_before.ru_stime,
+            'worker_peak_rss_kb': self_after.ru_maxrss,
+            'git_peak_rss_kb': peak_git_rss,
+        },
+    }
+    if options.keep:
+        report['workdir'] = workdir
+
+    if options.json:
+        print json.dumps(report, indent=4, sort_keys=True)
+        return
+
+    print 'messages:         %(messages)s (%(failed)s failed)' % report
+    print 'mix:              %s' % ', '.join(
+        '%s=%s' % item for item in sorted(report['mix'].items()))
+    print 'throughput:       %.1f/min (target %.1f/min)' % (
+        report['throughput_per_minute'], report['target_per_minute'])
+    print 'latency (s):      p50 %(p50).3f p90 %(p90).3f p99 %(p99).3f ' \
+        'max %(max).3f' % report['latency']
+    print 'backlog:          mean %(mean).1f max %(max)s' % report['backlog']
+    print 'worker cpu (s):   user %(worker_cpu_user).2f ' \
+        'system %(worker_cpu_system).2f' % report['resources']
+    print 'git cpu (s):      user %(git_cpu_user).2f ' \
+        'system %(git_cpu_system).2f' % report['resources']
+    print 'peak rss (kB):    worker %(worker_peak_rss_kb)s ' \
+        'git %(git_peak_rss_kb)s' % report['resources']
+
+
+if __name__ == '__main__':
+    main()
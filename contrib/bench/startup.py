@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Startup benchmark for the git worker.
+
+Starts the worker in a fresh interpreter against a real bus and reports
+how long it takes until it starts consuming and how much memory it is
+using at that point.
+"""
+
+import json
+import logging
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+
+def _rss_kb():
+    """
+    Returns the current resident set size in kB.
+    """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(mq_config, config_file):
+    """
+    Runs the worker until it calls basic_consume, then reports and exits.
+    """
+    import pika.channel
+    # Time from here so the import figure does not include pika
+    start = time.time()
+
+    original_basic_consume = pika.channel.Channel.basic_consume
+
+    def basic_consume(channel, *args, **kwargs):
+        result = original_basic_consume(channel, *args, **kwargs)
+        sys.stdout.write(json.dumps({
+            'import': import_done - start,
+            'consume': time.time() - start,
+            'rss_kb': _rss_kb(),
+            'git_loaded': 'git' in sys.modules,
+        }) + '\n')
+        sys.stdout.flush()
+        os._exit(0)
+        return result
+
+    pika.channel.Channel.basic_consume = basic_consume
+
+    from replugin import gitworker
+    import_done = time.time()
+
+    logging.basicConfig(level=logging.ERROR)
+    worker = gitworker.GitWorker(
+        json.load(open(mq_config)),
+        config_file=config_file,
+        logger=logging.getLogger('startup'))
+    worker.run_forever()
+
+
+def _percentile(values, pct):
+    """
+    Returns the pct percentile of values.
+    """
+    values = sorted(values)
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-m', '--mq-config', default='conf/mq_conf.json',
+        help='bus configuration file')
+    parser.add_option(
+        '-c', '--config', default='conf/example.json',
+        help='worker configuration file')
+    parser.add_option(
+        '-n', '--runs', type='int', default=10,
+        help='number of worker starts to measure')
+    parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.mq_config, options.config)
+        return
+
+    results = []
+    for run in range(options.runs):
+        launched = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, __file__, '--child',
+             '-m', options.mq_config, '-c', options.config],
+            stdout=subprocess.PIPE)
+        line = proc.stdout.readline()
+        proc.wait()
+        if not line:
+            parser.error('worker exited before consuming (rc=%s)' % (
+                proc.returncode))
+        result = json.loads(line)
+        # Include interpreter startup in time-to-first-consume
+        result['total'] = time.time() - launched
+        results.append(result)
+
+    print 'runs: %s' % len(results)
+    for key, label in (
+            ('import', 'import replugin.gitworker (s)'),
+            ('consume', 'in-process time to first consume (s)'),
+            ('total', 'time to first consume (s)'),
+            ('rss_kb', 'RSS after startup (kB)')):
+        values = [r[key] for r in results]
+        print '%-40s min %-10.3f p50 %-10.3f max %.3f' % (
+            label, min(values), _percentile(values, 50), max(values))
+    print 'GitPython loaded before first consume: %s' % (
+        any(r['git_loaded'] for r in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,15 +17,38 @@
 Git worker.
 """
 
-import git
+import bisect
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import pika
+import re
+import resource
+import threading
 import time
 import os
 import shutil
 import subprocess
+import urlparse
 import uuid
 
 from reworker.worker import Worker
 
+#: GitPython, imported on first use by _load_git() to keep startup fast
+git = None
+
+
+def _load_git():
+    """
+    Imports GitPython if it has not been imported yet.
+    """
+    global git
+    if git is None:
+        import git
+    return git
+
 
 class GitWorkerError(Exception):
     """
@@ -34,6 +57,125 @@ class GitWorkerError(Exception):
     pass
 
 
+def normalize_repo_url(repo):
+    """
+    Returns a normalized form of a repo location so that the different
+    ways of writing the same repo (trailing slashes, .git suffix,
+    credentials, host case) map to the same key.
+    """
+    repo = repo.strip()
+    parsed = urlparse.urlsplit(repo)
+    if parsed.scheme and parsed.netloc:
+        host = parsed.hostname.lower()
+        if parsed.port:
+            host = '%s:%s' % (host, parsed.port)
+        path = parsed.path
+        normalized = '%s://%s%s' % (parsed.scheme.lower(), host, path)
+    elif '://' not in repo and ':' not in repo.split('/')[0]:
+        # A local path
+        normalized = os.path.abspath(repo)
+    else:
+        normalized = repo
+    normalized = normalized.rstrip('/')
+    if normalized.endswith('.git'):
+        normalized = normalized[:-4]
+    return normalized.rstrip('/')
+
+
+class BoundedOutput(object):
+    """
+    Collects the output of a command keeping only the first and last
+    lines so memory use does not grow with the amount of output.
+    """
+
+    def __init__(self, head_lines=20, tail_lines=100, line_bytes=4096):
+        self.head_lines = head_lines
+        self.line_bytes = line_bytes
+        self.head = []
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.omitted = 0
+
+    def append(self, line):
+        """
+        Adds a line of output.
+        """
+        if len(self.head) < self.head_lines:
+            self.head.append(line)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.omitted += 1
+        self.tail.append(line)
+
+    def consume(self, stream):
+        """
+        Reads stream until EOF, at most line_bytes at a time.
+        """
+        for line in iter(lambda: stream.readline(self.line_bytes), ''):
+            self.append(line.rstrip('\n'))
+        stream.close()
+
+    def __str__(self):
+        lines = list(self.head)
+        if self.omitted:
+            lines.append('... %s lines omitted ...' % self.omitted)
+        lines.extend(self.tail)
+        return '\n'.join(lines)
+
+
+def repo_key(repo):
+    """
+    Returns a stable hash of the normalized repo location.
+    """
+    return hashlib.sha1(normalize_repo_url(repo).encode('utf-8')).hexdigest()
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys onto a changing set of nodes. Adding
+    or removing a node only moves the keys that node gains or loses.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set()
+        self._ring = []
+        for node in nodes:
+            self.add_node(node)
+
+    def _hash(self, key):
+        """
+        Returns the position of key on the ring.
+        """
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def add_node(self, node):
+        """
+        Adds a node and its virtual nodes to the ring.
+        """
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            bisect.insort(
+                self._ring, (self._hash('%s#%s' % (node, replica)), node))
+
+    def remove_node(self, node):
+        """
+        Removes a node and its virtual nodes from the ring.
+        """
+        self.nodes.discard(node)
+        self._ring = [entry for entry in self._ring if entry[1] != node]
+
+    def get_node(self, key):
+        """
+        Returns the node owning key or None if the ring is empty.
+        """
+        if not self._ring:
+            return None
+        index = bisect.bisect_left(self._ring, (self._hash(key),))
+        return self._ring[index % len(self._ring)][1]
+
+
 class GitWorker(Worker):
     """
     Worker which provides basic functionality with Git.
@@ -43,8 +185,65 @@ class GitWorker(Worker):
     subcommands = ('CherryPickMerge', 'Merge')
     dynamic = []
 
+    #: Shard queue limits. They must be the same on every node since the
+    #: broker refuses to redeclare a queue with different arguments. Jobs
+    #: beyond the length limit or waiting longer than the TTL (in ms) are
+    #: dead-lettered back to the shared queue where any node runs them.
+    shard_queue_max_length = 50
+    shard_queue_ttl = 300000
+
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        self._busy = False
+        self._last_activity = time.time()
+        self._git_version = None
+        self._cache_stats = {'hits': 0, 'misses': 0}
+        self._maintenance_stats = {}
+        self._job_stats = {}
+        self._affinity = self._config.get('affinity')
+        self._ring = None
+        self._members_mtime = None
+        self._affinity_channel = None
+        self._members_check_connection = None
+        self._shard_consumers = {}
+        if self._affinity:
+            self._ring = HashRing()
+            if self._affinity.get('members_dir'):
+                heartbeat_thread = threading.Thread(
+                    target=self._heartbeat_loop, name='affinity-heartbeat')
+                heartbeat_thread.daemon = True
+                heartbeat_thread.start()
+            self._refresh_members()
+        if (self._config.get('cache_dir') and
+                self._config.get('maintenance') is not None):
+            maintenance_thread = threading.Thread(
+                target=self._maintenance_loop,
+                name='git-maintenance')
+            maintenance_thread.daemon = True
+            maintenance_thread.start()
+        if self._config.get('prewarm', False):
+            prewarm_thread = threading.Thread(
+                target=self._prewarm, name='git-prewarm')
+            prewarm_thread.daemon = True
+            prewarm_thread.start()
+
+    def _prewarm(self):
+        """
+        Loads GitPython and probes the git binary ahead of the first
+        message so it overlaps with connecting to the bus.
+        """
+        start = time.time()
+        _load_git()
+        try:
+            self._get_git_version()
+        except Exception, ex:
+            self.app_logger.warn('Unable to probe git version: %s' % ex)
+        self.app_logger.debug(
+            'Pre-warmed git support in %.3fs' % (time.time() - start))
+
     # Subcommand methods
     def cherry_pick_merge(self, body, corr_id, output):
+        _load_git()
         # Get neede ic variables
         params = body.get('parameters', {})
 
@@ -65,33 +264,24 @@ class GitWorker(Worker):
             result_data = {
                 "cherry_pick": [],
             }
-            # Create a git command wrapper
-            gitcmd = git.cmd.Git(workspace)
-
             # Clone
-            location_type = 'local'
-            if (
-                    repo.startswith('http://') or
-                    repo.startswith('https://') or
-                    repo.startswith('ssh://')):
-                location_type = 'remote'
-            output.info('Cloning %s %s' % (location_type, repo))
-            gitcmd.clone(repo, workspace)
-            local_repo = git.Repo(workspace)
+            local_repo = self._clone(repo, workspace, output)
             output.info('Checking out branch %s for work' % temp_branch)
-            local_repo.git.checkout(b=temp_branch)
+            self._run_git(workspace, 'checkout', '-b', temp_branch)
             for commit in commits:
                 self.app_logger.info("Going to cherry pick %s now" % commit)
-                local_repo.git.cherry_pick(commit)
+                self._run_git(workspace, 'cherry-pick', commit)
                 result_data['cherry_pick'].append(commit)
                 output.info('Cherry picked %s' % commit)
                 self.app_logger.info("Cherry picked %s successfully" % commit)
 
-            local_repo.git.fetch('origin', to_branch)
-            local_repo.git.checkout(to_branch)
-            local_repo.git.pull('origin', to_branch)
-            local_repo.git.merge(temp_branch, squash=True)
-            local_repo.git.commit(m="Commit for squash-merge of release: %s" % corr_id)
+            self._run_git(workspace, 'fetch', 'origin', to_branch)
+            self._run_git(workspace, 'checkout', to_branch)
+            self._run_git(workspace, 'pull', 'origin', to_branch)
+            self._run_git(workspace, 'merge', '--squash', temp_branch)
+            self._run_git(
+                workspace, 'commit',
+                '-m', "Commit for squash-merge of release: %s" % corr_id)
 
             result_data['commit'] = local_repo.commit().hexsha
             result_data['branch'] = to_branch
@@ -123,7 +313,7 @@ class GitWorker(Worker):
                         output.warn(
                             '%s is not in the allowed scripts list. Skipped.')
 
-            local_repo.git.push("origin", to_branch, force=True)
+            self._run_git(workspace, 'push', '--force', 'origin', to_branch)
             # Remove the workspace after work is done (unless
             # keep_workspace is True)
             if not params.get('keep_workspace', False):
@@ -134,13 +324,17 @@ class GitWorker(Worker):
             return {'status': 'completed', 'data': result_data}
         except KeyError, ke:
             raise GitWorkerError('Missing input %s' % ke)
-        except git.GitCommandError, gce:
-            raise GitWorkerError('Git error: %s' % gce)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError,
+                git.BadObject, ValueError), gpe:
+            # Raised by GitPython reading the workspace; ValueError is
+            # what it raises for a missing HEAD
+            raise GitWorkerError('Git error: %s' % gpe)
 
     def merge(self, body, corr_id, output):
         """
         Merge a branch into another branch.
         """
+        _load_git()
         params = body.get('parameters', {})
 
         try:
@@ -154,26 +348,16 @@ class GitWorker(Worker):
 
             # Create a workspace
             workspace = self._create_workspace()
-            # Create a git command wrapper
-            gitcmd = git.cmd.Git(workspace)
             # Clone
-            location_type = 'local'
-            if (
-                    repo.startswith('http://') or
-                    repo.startswith('https://') or
-                    repo.startswith('ssh://')):
-                location_type = 'remote'
-            output.info('Cloning %s %s' % (location_type, repo))
-            gitcmd.clone(repo, workspace)
-            local_repo = git.Repo(workspace)
+            local_repo = self._clone(repo, workspace, output)
             output.info('Checking out branch %s to merge into' % to_branch)
             # Make sure we have the data from the server
-            local_repo.git.fetch('origin', from_branch)
-            local_repo.git.fetch('origin', to_branch)
+            self._run_git(workspace, 'fetch', 'origin', from_branch)
+            self._run_git(workspace, 'fetch', 'origin', to_branch)
             # Move onto the branch
-            local_repo.git.checkout(to_branch)
+            self._run_git(workspace, 'checkout', to_branch)
             # Do the work
-            local_repo.git.merge("origin/" + from_branch)
+            self._run_git(workspace, 'merge', 'origin/' + from_branch)
             output.info('Merged %s to %s successfully' % (
                 from_branch, to_branch))
             self.app_logger.info("Merged %s to %s successfully" % (
@@ -185,7 +369,7 @@ class GitWorker(Worker):
                 'to_branch': to_branch,
             }
 
-            local_repo.git.push("origin", to_branch, force=False)
+            self._run_git(workspace, 'push', 'origin', to_branch)
 
             # Remove the workspace after work is done (unless
             # keep_workspace is True)
@@ -197,8 +381,545 @@ class GitWorker(Worker):
             return {'status': 'completed', 'data': result_data}
         except KeyError, ke:
             raise GitWorkerError('Missing input %s' % ke)
-        except git.GitCommandError, gce:
-            raise GitWorkerError('Git error: %s' % gce)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError,
+                git.BadObject, ValueError), gpe:
+            # Raised by GitPython reading the workspace; ValueError is
+            # what it raises for a missing HEAD
+            raise GitWorkerError('Git error: %s' % gpe)
+
+    def _run_git(self, workspace, *args):
+        """
+        Runs a git command in workspace streaming its output into bounded
+        buffers and returns the bounded stdout. Raises GitWorkerError with
+        the head and tail of the output if the command fails.
+        """
+        limits = self._config.get('output_limits', {})
+        command = ['git'] + list(args)
+        self.app_logger.debug('Running: %s' % ' '.join(command))
+        try:
+            with open(os.devnull) as devnull:
+                process = subprocess.Popen(
+                    command,
+                    cwd=workspace,
+                    stdin=devnull,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    close_fds=True)
+        except OSError, ose:
+            raise GitWorkerError(
+                'Git error: unable to run %s in %s: %s' % (
+                    ' '.join(command), workspace, ose))
+
+        outputs = []
+        readers = []
+        for stream in (process.stdout, process.stderr):
+            bounded = BoundedOutput(
+                limits.get('head_lines', 20),
+                limits.get('tail_lines', 100),
+                limits.get('line_bytes', 4096))
+            reader = threading.Thread(target=bounded.consume, args=(stream,))
+            reader.daemon = True
+            reader.start()
+            outputs.append(bounded)
+            readers.append(reader)
+        for reader in readers:
+            reader.join()
+
+        # wait4 gives us the resource usage of this one git process
+        _, status, usage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self._job_stats['git_peak_rss_kb'] = max(
+            self._job_stats.get('git_peak_rss_kb', 0), usage.ru_maxrss)
+
+        stdout, stderr = outputs
+        if process.returncode != 0:
+            raise GitWorkerError(
+                'Git error: %s returned exit status %s\n'
+                'stdout: %s\nstderr: %s' % (
+                    ' '.join(command), process.returncode, stdout, stderr))
+        return str(stdout)
+
+    def _clone(self, repo, workspace, output):
+        """
+        Clones repo into workspace, going through the local repo cache
+        when cache_dir is configured.
+        """
+        location_type = 'local'
+        if (
+                repo.startswith('http://') or
+                repo.startswith('https://') or
+                repo.startswith('ssh://')):
+            location_type = 'remote'
+        output.info('Cloning %s %s' % (location_type, repo))
+        cache_path = self._cache_path(repo)
+        if cache_path is not None:
+            try:
+                self._clone_from_cache(repo, cache_path, workspace)
+                return git.Repo(workspace)
+            except GitWorkerError, gwe:
+                self.app_logger.warn(
+                    'Cloning %s through the repo cache failed, cloning '
+                    'without it: %s' % (repo, gwe))
+                # Start over from an empty workspace
+                if os.path.isdir(workspace) and os.listdir(workspace):
+                    shutil.rmtree(workspace)
+                    os.makedirs(workspace)
+        self._run_git(workspace, 'clone', repo, workspace)
+        return git.Repo(workspace)
+
+    def _clone_from_cache(self, repo, cache_path, workspace):
+        """
+        Refreshes the cached mirror of repo and clones workspace from it.
+        Raises GitWorkerError if the cache can not be used.
+        """
+        try:
+            self._ensure_cache_dir()
+            with self._repo_lock(cache_path):
+                self._update_cache(repo, cache_path)
+                # dissociate so the workspace does not depend on the
+                # cache once the lock is released
+                self._run_git(
+                    workspace, 'clone', '--reference', cache_path,
+                    '--dissociate', repo, workspace)
+        except (IOError, OSError), ex:
+            raise GitWorkerError(
+                'Unable to use repo cache %s: %s' % (cache_path, ex))
+        hits = self._cache_stats['hits']
+        total = hits + self._cache_stats['misses']
+        self.app_logger.info(
+            'Repo cache hit rate %.1f%% (%s of %s)' % (
+                100.0 * hits / total, hits, total))
+
+    def _cache_path(self, repo):
+        """
+        Returns the path of the cached copy of repo or None if caching
+        is not configured.
+        """
+        cache_dir = self._config.get('cache_dir')
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, repo_key(repo) + '.git')
+
+    def _ensure_cache_dir(self):
+        """
+        Creates cache_dir if it does not exist yet.
+        """
+        cache_dir = self._config['cache_dir']
+        try:
+            os.makedirs(cache_dir)
+            self.app_logger.info('Created repo cache at %s' % cache_dir)
+        except OSError:
+            # Another worker may have created it meanwhile
+            if not os.path.isdir(cache_dir):
+                raise
+
+    def _update_cache(self, repo, cache_path):
+        """
+        Creates or refreshes the cached mirror of repo. Must be called
+        while holding the repo lock.
+        """
+        if os.path.isdir(cache_path):
+            self.app_logger.debug('Updating cached repo %s' % cache_path)
+            try:
+                # Fetch from this job's repo; the mirror may have been
+                # created from another spelling of it
+                self._run_git(
+                    cache_path, 'fetch', '--prune', repo, '+refs/*:refs/*')
+                self._cache_stats['hits'] += 1
+                return
+            except GitWorkerError, gwe:
+                # e.g. a half written or corrupted mirror
+                self.app_logger.warn(
+                    'Cached repo %s is unusable, recreating it: %s' % (
+                        cache_path, gwe))
+                shutil.rmtree(cache_path)
+        self._cache_stats['misses'] += 1
+        self.app_logger.info('Caching %s at %s' % (repo, cache_path))
+        try:
+            self._run_git(
+                self._config['cache_dir'], 'clone', '--mirror',
+                repo, cache_path)
+        except GitWorkerError:
+            # Do not leave a partial mirror behind
+            shutil.rmtree(cache_path, ignore_errors=True)
+            raise
+
+    @contextlib.contextmanager
+    def _repo_lock(self, cache_path, blocking=True):
+        """
+        Holds an exclusive lock on a cached repo. Yields False if
+        blocking is False and the lock is held elsewhere.
+        """
+        lock_file = open(cache_path + '.lock', 'a')
+        try:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def _get_git_version(self):
+        """
+        Returns the version of the git binary as a tuple of ints.
+        """
+        if self._git_version is None:
+            version = git.cmd.Git().version()
+            self._git_version = tuple(
+                int(x) for x in re.findall(r'\d+', version)[:3])
+        return self._git_version
+
+    def _count_objects(self, cache_git):
+        """
+        Returns the output of git count-objects -v as a dict.
+        """
+        counts = {}
+        for line in cache_git.count_objects('-v').splitlines():
+            key, _, value = line.partition(':')
+            try:
+                counts[key.strip()] = int(value)
+            except ValueError:
+                pass
+        return counts
+
+    def _maintenance_loop(self):
+        """
+        Runs cache maintenance when the worker has been idle long enough.
+        """
+        conf = self._config['maintenance']
+        idle_seconds = conf.get('idle_seconds', 300)
+        interval = conf.get('interval', 3600)
+        poll = conf.get('poll', 30)
+        last_run = 0
+        while True:
+            time.sleep(poll)
+            now = time.time()
+            if self._busy or now - self._last_activity < idle_seconds:
+                continue
+            if now - last_run < interval:
+                continue
+            try:
+                # Only import GitPython once there is work to do
+                _load_git()
+                self._maintain_caches()
+            except Exception, ex:
+                # Keep the thread alive so maintenance runs next time
+                self.app_logger.error('Cache maintenance failed: %s' % ex)
+            last_run = time.time()
+
+    def _maintain_caches(self):
+        """
+        Runs maintenance on every cached repo not locked by a job.
+        """
+        cache_dir = self._config['cache_dir']
+        if not os.path.isdir(cache_dir):
+            return
+        for name in sorted(os.listdir(cache_dir)):
+            cache_path = os.path.join(cache_dir, name)
+            if not (name.endswith('.git') and os.path.isdir(cache_path)):
+                continue
+            # Jobs come first; finish the sweep at the next idle period
+            if self._busy:
+                self.app_logger.debug(
+                    'A job is running. Stopping cache maintenance.')
+                return
+            with self._repo_lock(cache_path, blocking=False) as locked:
+                if not locked:
+                    self.app_logger.debug(
+                        'Cached repo %s is in use. Skipping maintenance.' % (
+                            cache_path))
+                    continue
+                try:
+                    self._maintain_cache(cache_path)
+                except git.GitCommandError, gce:
+                    self.app_logger.warn(
+                        'Maintenance of %s failed: %s' % (cache_path, gce))
+
+    def _pack_sizes(self, cache_path):
+        """
+        Returns the sizes of the pack files of a cached repo.
+        """
+        pack_dir = os.path.join(cache_path, 'objects', 'pack')
+        if not os.path.isdir(pack_dir):
+            return []
+        return [
+            os.path.getsize(os.path.join(pack_dir, name))
+            for name in os.listdir(pack_dir) if name.endswith('.pack')]
+
+    def _maintenance_commands(self, cache_path):
+        """
+        Yields the git commands maintaining a cached repo with the
+        installed git. Commands are worked out as the previous ones run
+        since some depend on the packs left behind.
+        """
+        git_version = self._get_git_version()
+        max_packs = self._config.get('maintenance', {}).get(
+            'max_packs', 10)
+        yield ['reflog', 'expire', '--expire=90.days.ago', '--all']
+        # Loose objects go into one new pack
+        yield ['repack', '-d', '-l']
+        yield ['prune', '--expire=2.weeks.ago']
+        if git_version >= (2, 23):
+            yield ['multi-pack-index', 'write']
+            yield ['multi-pack-index', 'expire']
+            # Fold every pack but the largest into one, leaving the
+            # large base pack alone so each run stays cheap
+            sizes = sorted(self._pack_sizes(cache_path))
+            if len(sizes) > 2:
+                yield ['multi-pack-index', 'repack',
+                       '--batch-size=%s' % sum(sizes[:-1])]
+                yield ['multi-pack-index', 'expire']
+        else:
+            # No incremental repack; fall back to a full one once the
+            # packs pile up
+            if len(self._pack_sizes(cache_path)) > max_packs:
+                yield ['repack', '-a', '-d', '-l']
+            if git_version >= (2, 21):
+                yield ['multi-pack-index', 'write']
+        if git_version >= (2, 24):
+            yield ['commit-graph', 'write', '--reachable', '--split']
+        elif git_version >= (2, 19):
+            yield ['commit-graph', 'write', '--reachable']
+
+    def _maintain_cache(self, cache_path):
+        """
+        Repacks and writes commit-graph/multi-pack-index files for a
+        cached repo. Must be called while holding the repo lock.
+        """
+        cache_git = git.cmd.Git(cache_path)
+        before = self._count_objects(cache_git)
+        start = time.time()
+        for command in self._maintenance_commands(cache_path):
+            cache_git.execute(['git'] + command)
+        duration = time.time() - start
+        after = self._count_objects(cache_git)
+        self._maintenance_stats[cache_path] = {
+            'duration': duration,
+            'before': before,
+            'after': after,
+            'finished': time.time(),
+        }
+        self.app_logger.info(
+            'Maintained %s in %.2fs. Loose objects %s -> %s, '
+            'packs %s -> %s' % (
+                cache_path, duration,
+                before.get('count'), after.get('count'),
+                before.get('packs'), after.get('packs')))
+
+    def _on_channel_open(self, channel):
+        """
+        Also consumes from the shard queues this node owns when affinity
+        routing is enabled.
+        """
+        Worker._on_channel_open(self, channel)
+        if self._affinity:
+            if channel is not self._affinity_channel:
+                # Consumer tags from a previous channel are gone with it
+                self._shard_consumers = {}
+            self._affinity_channel = channel
+            self._rebalance()
+            if ((self._affinity.get('members_file') or
+                    self._affinity.get('members_dir')) and
+                    self._members_check_connection is not channel.connection):
+                self._members_check_connection = channel.connection
+                self._schedule_members_check(channel.connection)
+
+    def _schedule_members_check(self, connection):
+        """
+        Re-reads the members periodically so idle nodes rebalance. Only
+        one check runs per connection.
+        """
+        def check():
+            if connection is not self._members_check_connection:
+                return
+            self._refresh_members()
+            self._schedule_members_check(connection)
+
+        connection.add_timeout(self._affinity.get('members_poll', 30), check)
+
+    def _heartbeat(self):
+        """
+        Touches this node's file in members_dir to show it is alive.
+        """
+        heartbeat = os.path.join(
+            self._affinity['members_dir'], self._affinity['node'])
+        open(heartbeat, 'a').close()
+        os.utime(heartbeat, None)
+
+    def _heartbeat_loop(self):
+        """
+        Keeps this node's heartbeat fresh, including during long jobs.
+        """
+        while True:
+            try:
+                self._heartbeat()
+            except (IOError, OSError), ex:
+                self.app_logger.warn('Unable to write heartbeat: %s' % ex)
+            time.sleep(self._affinity.get('members_poll', 30))
+
+    def _live_members(self):
+        """
+        Returns the nodes in members_dir whose heartbeat is recent enough.
+        """
+        members_dir = self._affinity['members_dir']
+        member_ttl = self._affinity.get(
+            'member_ttl', 3 * self._affinity.get('members_poll', 30))
+        now = time.time()
+        nodes = set()
+        for name in os.listdir(members_dir):
+            if name.startswith('.'):
+                continue
+            try:
+                mtime = os.stat(os.path.join(members_dir, name)).st_mtime
+            except OSError:
+                continue
+            if now - mtime <= member_ttl:
+                nodes.add(name)
+        return nodes
+
+    def _refresh_members(self):
+        """
+        Updates the hash ring from the live nodes in members_dir, the
+        members file or the configured nodes and rebalances the shard
+        consumers if membership changed.
+        """
+        members_dir = self._affinity.get('members_dir')
+        members_file = self._affinity.get('members_file')
+        if members_dir:
+            try:
+                nodes = self._live_members()
+            except OSError, ose:
+                self.app_logger.warn(
+                    'Unable to read members dir %s: %s' % (members_dir, ose))
+                return
+        elif members_file:
+            try:
+                mtime = os.stat(members_file).st_mtime
+            except OSError, ose:
+                self.app_logger.warn(
+                    'Unable to read members file %s: %s' % (
+                        members_file, ose))
+                return
+            if mtime == self._members_mtime:
+                return
+            self._members_mtime = mtime
+            nodes = set(
+                line.strip() for line in open(members_file)
+                if line.strip() and not line.startswith('#'))
+        else:
+            nodes = set(self._affinity.get('nodes', []))
+        nodes.add(self._affinity['node'])
+
+        if nodes == self._ring.nodes:
+            return
+        for node in self._ring.nodes - nodes:
+            self._ring.remove_node(node)
+        for node in nodes - self._ring.nodes:
+            self._ring.add_node(node)
+        self.app_logger.info(
+            'Affinity members are now: %s' % ', '.join(sorted(nodes)))
+        if self._affinity_channel is not None:
+            self._rebalance()
+
+    def _shard_for(self, repo):
+        """
+        Returns the shard number a repo belongs to.
+        """
+        return int(repo_key(repo), 16) % self._affinity.get('shards', 64)
+
+    def _shard_queue(self, shard):
+        """
+        Returns the name of the queue for a shard.
+        """
+        return '%s.shard.%s' % (self._queue, shard)
+
+    def _declare_shard_queue(self, channel, shard):
+        """
+        Declares the queue for a shard. Overflowing or expired messages
+        fall back to the shared queue where any node may pick them up.
+        """
+        channel.queue_declare(
+            None,
+            queue=self._shard_queue(shard),
+            durable=True,
+            arguments={
+                'x-max-length': self.shard_queue_max_length,
+                'x-message-ttl': self.shard_queue_ttl,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self._queue,
+            })
+
+    def _rebalance(self):
+        """
+        Starts consuming newly owned shard queues and cancels consumers
+        for shards now owned by another node.
+        """
+        channel = self._affinity_channel
+        node = self._affinity['node']
+        owned = set(
+            shard for shard in range(self._affinity.get('shards', 64))
+            if self._ring.get_node(str(shard)) == node)
+
+        for shard in set(self._shard_consumers) - owned:
+            channel.basic_cancel(
+                consumer_tag=self._shard_consumers.pop(shard))
+        for shard in owned - set(self._shard_consumers):
+            self._declare_shard_queue(channel, shard)
+            self._shard_consumers[shard] = channel.basic_consume(
+                self._process, queue=self._shard_queue(shard))
+        self.app_logger.info(
+            'Node %s now owns %s shards' % (node, len(owned)))
+
+    def _forward_to_owner(self, channel, properties, body):
+        """
+        Forwards a message from the shared queue to the shard queue of
+        the node owning its repo. Returns True if it was forwarded.
+        """
+        if not self._affinity:
+            return False
+        self._refresh_members()
+        headers = dict(getattr(properties, 'headers', None) or {})
+        # Already routed or overflowed back to the shared queue
+        if 'x-affinity-node' in headers or 'x-death' in headers:
+            return False
+        try:
+            repo = body['parameters']['repo']
+        except (KeyError, TypeError):
+            return False
+
+        shard = self._shard_for(repo)
+        owner = self._ring.get_node(str(shard))
+        if owner == self._affinity['node']:
+            return False
+
+        headers['x-affinity-node'] = owner
+        # The owner may not have declared the queue yet. Publishing to a
+        # missing queue would silently drop the job.
+        self._declare_shard_queue(channel, shard)
+        channel.basic_publish(
+            exchange='',
+            routing_key=self._shard_queue(shard),
+            body=json.dumps(body),
+            properties=pika.BasicProperties(
+                correlation_id=properties.correlation_id,
+                reply_to=properties.reply_to,
+                headers=headers,
+                delivery_mode=2))
+        self.app_logger.info(
+            'Forwarded %s for %s to shard %s on %s' % (
+                properties.correlation_id, repo, shard, owner))
+        return True
 
     def _create_workspace(self):
         """
@@ -235,7 +956,11 @@ class GitWorker(Worker):
         """
         # Ack the original message
         self.ack(basic_deliver)
+        if self._forward_to_owner(channel, properties, body):
+            return
         corr_id = str(properties.correlation_id)
+        self._busy = True
+        self._job_stats = {'started': time.time()}
 
         try:
             try:
@@ -303,6 +1028,19 @@ class GitWorker(Worker):
                 'failed',
                 corr_id)
             output.error(str(fwe))
+        finally:
+            self._busy = False
+            self._last_activity = time.time()
+            # ru_maxrss of the worker is a high-water mark over its lifetime
+            self._job_stats['worker_peak_rss_kb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            self._job_stats['duration'] = (
+                self._last_activity - self._job_stats['started'])
+            self.app_logger.info(
+                'Job %s took %.2fs. Peak RSS: git %s kB, worker %s kB' % (
+                    corr_id, self._job_stats['duration'],
+                    self._job_stats.get('git_peak_rss_kb', 0),
+                    self._job_stats['worker_peak_rss_kb']))
 
 
 def main():  # pragma: no cover